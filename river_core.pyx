@@ -0,0 +1,253 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""Compiled search kernel for `river_crossing.py`
+
+Runs the same depth-first search as `Solver.search`, without the memo, over C arrays. The choices
+of horses and the lower bounds still come from `river_crossing.py`, and are copied into C arrays
+the first time the search reaches each bitmask
+"""
+from libc.stdint cimport int64_t, uint32_t
+from libc.stdlib cimport malloc, calloc, realloc, free
+from heapq import heappush, heappushpop
+
+cdef extern from *:
+    int __builtin_ctz(unsigned int x) nogil
+
+# Pool and bound tables have 2^N entries each
+MAX_HORSES = 20
+
+cdef int64_t NO_LIMIT = 1LL << 62
+
+
+cdef struct Pool:
+    uint32_t* choices
+    int size
+
+
+cdef class Kernel:
+    """Search state shared by the whole search
+
+    Arguments:
+        choice_time (list[int]): Crossing time of every group of horses, indexed by bitmask
+        time_max (int | None)  : The limit on amount of time each horse can go. None for no limit
+        optimal_only (bool)    : Whether to only keep the solutions with the least total time
+        max_solutions (int)    : Number of fastest completions to keep; 0 for all
+        step_pool (Callable)   : `step_pool(passed_mask, passed)` from `river_crossing.py`
+        lower_bound (Callable) : `lower_bound(passed_mask, passed)` from `river_crossing.py`
+        twin_prev (list[int] | None): Previous horse with the same speed as each horse, or -1 if
+                                      none. None to not skip steps that only swap such horses
+
+    Properties:
+        completions (list): Completions kept, relative to the starting state. With `max_solutions`,
+                            a heap of (-time, -number, completion), so the slowest is at the top
+        num_found (int)   : Number of completions found
+    """
+    cdef int n
+    cdef uint32_t full_mask
+    cdef int64_t time_max
+    cdef bint optimal_only
+    cdef Py_ssize_t max_solutions
+    cdef int64_t best_total
+    cdef int64_t* choice_time
+    cdef int64_t* spent
+    cdef int* twin_prev
+    cdef bint break_symmetry
+    cdef Pool* pools[2]
+    cdef int64_t* bounds[2]
+    cdef uint32_t* path
+    cdef int path_cap
+    cdef object step_pool
+    cdef object lower_bound
+    cdef public list completions
+    cdef public int64_t num_found
+
+    def __cinit__(self, int n, list choice_time, object time_max, bint optimal_only,
+                  Py_ssize_t max_solutions, object step_pool, object lower_bound, list twin_prev):
+        cdef Py_ssize_t size = (<Py_ssize_t>1) << n
+        cdef Py_ssize_t i
+        cdef int side
+        if n > MAX_HORSES:
+            raise ValueError(f"At most {MAX_HORSES} horses are supported. Current number {n}")
+        self.n = n
+        self.full_mask = <uint32_t>(size - 1)
+        self.time_max = NO_LIMIT if time_max is None else time_max
+        self.optimal_only = optimal_only
+        self.max_solutions = max_solutions
+        self.break_symmetry = twin_prev is not None
+        self.best_total = NO_LIMIT
+        self.step_pool = step_pool
+        self.lower_bound = lower_bound
+        self.completions = []
+        self.num_found = 0
+        self.path_cap = 64
+        self.choice_time = <int64_t*>malloc(size * sizeof(int64_t))
+        self.spent = <int64_t*>calloc(n if n > 0 else 1, sizeof(int64_t))
+        self.twin_prev = <int*>malloc((n if n > 0 else 1) * sizeof(int))
+        self.path = <uint32_t*>malloc(self.path_cap * sizeof(uint32_t))
+        for side in range(2):
+            self.pools[side] = <Pool*>calloc(size, sizeof(Pool))
+            self.bounds[side] = <int64_t*>malloc(size * sizeof(int64_t))
+        if (not self.choice_time or not self.spent or not self.twin_prev or not self.path
+                or not self.pools[0] or not self.pools[1] or not self.bounds[0] or not self.bounds[1]):
+            raise MemoryError()
+        for i in range(n):
+            self.twin_prev[i] = -1 if twin_prev is None else twin_prev[i]
+        for i in range(size):
+            self.choice_time[i] = choice_time[i]
+            self.bounds[0][i] = -1
+            self.bounds[1][i] = -1
+
+    def __dealloc__(self):
+        cdef Py_ssize_t i
+        cdef int side
+        for side in range(2):
+            if self.pools[side]:
+                for i in range((<Py_ssize_t>1) << self.n):
+                    free(self.pools[side][i].choices)
+                free(self.pools[side])
+            free(self.bounds[side])
+        free(self.choice_time)
+        free(self.spent)
+        free(self.twin_prev)
+        free(self.path)
+
+    cdef Pool* get_pool(self, uint32_t passed_mask, bint passed) except NULL:
+        cdef Pool* pool = &self.pools[passed][passed_mask]
+        cdef list choices
+        cdef int i
+        if not pool.choices:
+            choices = self.step_pool(passed_mask, passed)
+            # Allocate at least 1 entry so that an empty pool is still filled in
+            pool.choices = <uint32_t*>malloc((len(choices) or 1) * sizeof(uint32_t))
+            if not pool.choices:
+                raise MemoryError()
+            for i in range(len(choices)):
+                pool.choices[i] = choices[i]
+            pool.size = len(choices)
+        return pool
+
+    cdef int64_t get_bound(self, uint32_t passed_mask, bint passed) except -1:
+        cdef int64_t bound = self.bounds[passed][passed_mask]
+        if bound < 0:
+            bound = self.bounds[passed][passed_mask] = self.lower_bound(passed_mask, passed)
+        return bound
+
+    cdef int record(self, int64_t tot_time, int depth) except -1:
+        cdef tuple path = ()
+        cdef tuple completion
+        cdef int i
+        if self.optimal_only and tot_time < self.best_total:
+            self.best_total = tot_time
+            self.completions.clear()
+            self.num_found = 0
+        self.num_found += 1
+        # Ties lose to the ones found earlier, so the slowest or the last found is dropped
+        if (self.max_solutions > 0 and len(self.completions) == self.max_solutions
+                and tot_time >= -self.completions[0][0]):
+            return 0
+        for i in range(depth - 1, -1, -1):
+            path = (self.path[i], path)
+        completion = (tot_time, tuple([self.spent[i] for i in range(self.n)]), path)
+        if self.max_solutions <= 0:
+            self.completions.append(completion)
+        elif len(self.completions) < self.max_solutions:
+            heappush(self.completions, (-tot_time, -self.num_found, completion))
+        else:
+            heappushpop(self.completions, (-tot_time, -self.num_found, completion))
+        return 0
+
+    cdef int dfs(self, uint32_t passed_mask, bint passed, int64_t tot_time, int depth) except -1:
+        cdef Pool* pool = self.get_pool(passed_mask, passed)
+        cdef uint32_t choice, rest, new_mask
+        cdef uint32_t avail = passed_mask if passed else ~passed_mask & self.full_mask
+        cdef int i, twin
+        cdef int64_t time, new_tot
+        cdef uint32_t* grown
+        cdef int c
+        cdef bint viable
+        if depth >= self.path_cap:
+            grown = <uint32_t*>realloc(self.path, 2 * self.path_cap * sizeof(uint32_t))
+            if not grown:
+                raise MemoryError()
+            self.path = grown
+            self.path_cap *= 2
+        for c in range(pool.size):
+            choice = pool.choices[c]
+            time = self.choice_time[choice]
+            # Has to not exceed time limit
+            viable = True
+            rest = choice
+            while rest:
+                if self.spent[__builtin_ctz(rest)] > self.time_max - time:
+                    viable = False
+                    break
+                rest &= rest - 1
+            # Has to not just swap horses of the same speed of another step
+            rest = choice if self.break_symmetry else 0
+            while viable and rest:
+                i = __builtin_ctz(rest)
+                twin = self.twin_prev[i]
+                if (twin >= 0 and not (choice >> twin) & 1 and (avail >> twin) & 1
+                        and self.spent[twin] == self.spent[i]):
+                    viable = False
+                rest &= rest - 1
+            if not viable:
+                continue
+            new_mask = passed_mask ^ choice
+            new_tot = tot_time + time
+            # Has to be able to beat the best solution so far
+            if self.optimal_only and new_tot + self.get_bound(new_mask, not passed) > self.best_total:
+                continue
+            rest = choice
+            while rest:
+                self.spent[__builtin_ctz(rest)] += time
+                rest &= rest - 1
+            self.path[depth] = choice
+            if new_mask == self.full_mask:
+                self.record(new_tot, depth + 1)
+            else:
+                self.dfs(new_mask, not passed, new_tot, depth + 1)
+            rest = choice
+            while rest:
+                self.spent[__builtin_ctz(rest)] -= time
+                rest &= rest - 1
+        return 0
+
+
+def solve(int n, list choice_time, object time_max, bint optimal_only, Py_ssize_t max_solutions,
+          object step_pool, object lower_bound, list twin_prev,
+          uint32_t passed_mask=0, tuple spent=None, bint passed=False, object budget=None):
+    """Run the search from a state
+
+    Arguments:
+        n (int)                : Number of horses
+        choice_time (list[int]): Crossing time of every group of horses, indexed by bitmask
+        time_max (int | None)  : The limit on amount of time each horse can go. None for no limit
+        optimal_only (bool)    : Whether to only keep the solutions with the least total time
+        max_solutions (int)    : Number of fastest completions to keep; 0 for all
+        step_pool (Callable)   : `step_pool(passed_mask, passed)` from `river_crossing.py`
+        lower_bound (Callable) : `lower_bound(passed_mask, passed)` from `river_crossing.py`
+        twin_prev (list[int] | None): Previous horse with the same speed as each horse, or -1 if
+                                      none. None to not skip steps that only swap such horses
+        passed_mask (int)      : Bitmask of the horses on the other side at the start
+        spent (tuple[int, ...]): Amount of time each horse has accured at the start. None for none
+        passed (bool)          : Whether the human is on the other side of the water at the start
+        budget (int | None)    : Only look for completions that take at most this much time in
+                                 optimal mode. None for no limit
+
+    Returns:
+        (int)             : Number of completions from the state
+        (list[Completion]): The `max_solutions` fastest of them, or all of them if it's 0, as
+                            (time, spent, path)
+    """
+    cdef Kernel kernel = Kernel(n, choice_time, time_max, optimal_only, max_solutions, step_pool,
+                                lower_bound, twin_prev)
+    cdef int i
+    if spent is not None:
+        for i in range(n):
+            kernel.spent[i] = spent[i]
+    if budget is not None:
+        kernel.best_total = budget
+    kernel.dfs(passed_mask, passed, 0, 0)
+    if max_solutions > 0:
+        return kernel.num_found, [entry[2] for entry in sorted(kernel.completions, reverse=True)]
+    return kernel.num_found, kernel.completions
@@ -1,28 +1,30 @@
 #!/usr/bin/env python3
 import math
 import json
+import os
+import heapq
+import platform
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from itertools import combinations
-from typing import Tuple, List, Generator, Dict
+from operator import itemgetter, attrgetter
+from string import Template
+from typing import Tuple, List, Generator, Iterable, Callable
 
-CONFIG_PATH = "config.json"
-SOLUTION_PATH = "solution.json"
+# The compiled search kernel is optional, and only loaded by `load_kernel`
+river_core = None
 
+# orjson writes the solutions much faster, but the standard json module works too
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-@dataclass
-class Horse:
-    """Data of each horse at each instant
-
-    Properties:
-        id_    (str) : ID of horse
-        speed  (int) : Amount of time the horse takes to cross the river
-        spent  (int) : Amount of time the horse has accured crossing the river
-        passed (bool): Whether the horse is on the other side of the river
-    """
-    id_: str
-    speed: int
-    spent: int = 0
-    passed: bool = False
+CONFIG_PATH = "config.json"
+SOLUTION_PATH = "solution.json"
 
 
 @dataclass
@@ -31,183 +33,579 @@ class Solution:
 
     Properties:
         total_time  (int)            : Total time for this solution
-        horses_time (tuple[int, ...]): Total time each horse accured
+        horses_time (tuple[int, ...]): Total time each horse accured, in the same order as the IDs
         path  (list[tuple[str, ...]]): Steps for this solution
     """
+    __slots__ = ("total_time", "horses_time", "path")
     total_time: int
     horses_time: Tuple[int, ...]
     path: List[Tuple[str, ...]]
 
 
-class Step:
-    """Tree node for each step
+# Search state, as (passed_mask, spent, passed), where `spent` is packed
+State = Tuple[int, int, bool]
+# Steps as a linked list of (choice, rest), ending with ()
+Path = tuple
+# Way to finish from a state, as (time, spent, path) relative to that state
+Completion = Tuple[int, Tuple[int, ...], Path]
+
+
+def bits(mask: int) -> Generator[int, None, None]:
+    """Generate the indices of the set bits of a mask, lowest first
 
     Arguments:
-        parent (Step)             : Parent node
-        horses (dict[str, Horse]) : Conditions of each horse at the moment
-        choice (tuple[Horse, ...]): The ids of the horses chosen to move in this step
-        passed_after (bool)       : Whether the human is on the other side of the water after this step
+        mask (int): Bitmask over horse indices
 
-    Properties:
-        parent (Step)             : Same as args.parent
-        horses (dict[str, Horse]) : Same as args.horses; copied
-        choice (tuple[Horse, ...]): Horses corresponding to args.choice
-        passed (bool)             : Same as args.passed_after
-        time   (int)              : Amount of time for this step
-        is_viable.getter    (bool)          : Whether this step is legal
-        avail_horses.getter (Generator[str]): Generator of available horses to be used for next step
-        all_passed.getter   (bool)          : Whether all horses are on the other side (end of solution)
-        tot_time.getter     (int)           : Total time spent on the steps up to (incl.) this one
-        horse_time.getter  (tuple[int, ...]): Amount of time each horse accured up to (incl.) this step
-        path.getter  (List[Tuple[str, ...]]): Path taken so far
-    """
-
-    def __init__(self, parent, horses: Dict[str, Horse], choice: Tuple[str, ...], passed_after: bool) -> None:
-        self.parent = parent
-        self.horses = {h.id_: Horse(
-            h.id_, h.speed, h.spent, h.passed) for h in horses.values()}
-        self.choice: Tuple[Horse, ...] = tuple(
-            (self.horses[hn] for hn in choice))
-        self.passed = passed_after
-        self.time = max((h.speed for h in self.choice))
-
-    @property
-    def is_viable(self) -> bool:
-        return all((h.spent <= (TIME_MAX - self.time) for h in self.choice))
-
-    @property
-    def avail_horses(self) -> Generator[str, None, None]:
-        return (h.id_ for h in self.horses.values() if h.passed == self.passed)
-
-    @property
-    def all_passed(self) -> bool:
-        return all((h.passed for h in self.horses.values()))
-
-    @property
-    def tot_time(self) -> int:
-        return self.parent.tot_time + self.time
-
-    @property
-    def horse_time(self) -> Tuple[int, ...]:
-        return tuple(h.spent for h in sorted(self.horses.values(), key=lambda h: h.id_))
-
-    @property
-    def path(self) -> List[Tuple[str, ...]]:
-        return self.parent.path + [tuple((h.id_ for h in self.choice))]
-
-    def execute(self) -> List[Solution]:
-        """Generate child nodes and run testing on each path
+    Returns:
+        (Generator[int]): Horse indices in the mask
+    """
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
 
-        Returns:
-            (list[Solution]): List of solutions that pass through this node
-        """
-        # print(f"Current: {self.path}")
-        for h in self.choice:
-            h.passed ^= True
-            h.spent += self.time
-        if self.all_passed:
-            paths = [Solution(self.tot_time, self.horse_time, self.path)]
-            return paths
-        avail_horses = tuple(self.avail_horses)
-        if self.passed:
-            step_pool = ((c, ) for c in avail_horses)
-        else:
-            step_pool = (c for r in range(2, HORSE_LIMIT + 1)
-                         for c in combinations(avail_horses, r))
-        pot_children = (Step(self, self.horses, choice, not self.passed)
-                        for choice in step_pool)
-        # Check each potential children
-        paths: List[Solution] = []
-        for s in pot_children:
-            # Has to not exceed time limit
-            if not s.is_viable:
-                continue
-            # Kinda recursion
-            children_paths = s.execute()
-            if len(children_paths) > 0:
-                paths += children_paths
-        return paths
 
+def forward_choices(avail: int) -> List[int]:
+    """Choices of horses to bring over. Always bring at least 2 horses over
 
-class RootStep(Step):
-    """Topmost tree node
+    Arguments:
+        avail (int): Bitmask of the horses on this side
+
+    Returns:
+        (list[int]): Bitmasks of the horses to bring over, in combination order. In optimal mode,
+            fastest first, and most horses first among equally fast ones, so that good solutions
+            are found early and prune more of the search
+    """
+    avail_horses = tuple(bits(avail))
+    choices = [sum(1 << i for i in c) for r in range(2, HORSE_LIMIT + 1)
+               for c in combinations(avail_horses, r)]
+    if OPTIMAL_ONLY:
+        choices.sort(key=lambda c: (CHOICE_TIME[c], -bin(c).count("1")))
+    return choices
+
+
+def backward_choices(avail: int) -> List[int]:
+    """Choices of horses to bring back. Only bring back 1 horse
 
     Arguments:
-        horse_times (list[int]): List of times each horse takes to cross the river
+        avail (int): Bitmask of the horses on the other side
 
-    Properties:
-        parent (None)            : No parent
-        horses (dict[str, Horse]): All horses present
-        choice (tuple)           : None
-        passed (bool)            : No crossing water yet
-        time   (int)             : Placeholder step. No time taken
-        is_viable.getter    (bool)          : Inherited. No use
-        avail_horses.getter (Generator[str]): Inherited. No use. Available horses are all horses
-        all_passed.getter   (bool)          : Inherited. No use. No horse on the other side
-        tot_time.getter     (int)           : Inherited. No time spent yet
-        horse_time.getter  (tuple[int, ...]): Inherited. No use. No actions yet
-        path.getter  (List[Tuple[str, ...]]): Inherited. No path taken yet
+    Returns:
+        (list[int]): Bitmasks of the horse to bring back. In optimal mode, fastest first
     """
+    choices = [1 << i for i in bits(avail)]
+    if OPTIMAL_ONLY:
+        choices.sort(key=CHOICE_TIME.__getitem__)
+    return choices
+
+
+def lower_bound(passed_mask: int, passed: bool) -> int:
+    """Lower bound on the time needed to get the remaining horses over
+
+    Every horse left has to go over in some trip, which costs at least as much as the slowest
+    horse in it, so the cost of the trips is at least that of the horses left grouped slowest
+    first. Every other trip costs at least as much as the fastest horse
+
+    Arguments:
+        passed_mask (int): Bitmask of the horses on the other side
+        passed (bool)    : Whether the human is on the other side of the water
+
+    Returns:
+        (int): Lower bound on the time left
+    """
+    left = sorted((SPEEDS[i] for i in bits(~passed_mask & FULL_MASK)), reverse=True)
+    if not left:
+        return 0
+    fastest = min(SPEEDS)
+    # A horse has to be brought back before going over again
+    to_move = len(left) + passed
+    # Each round trip gets at most `HORSE_LIMIT - 1` horses over
+    trips = max(-(-(to_move - 1) // (HORSE_LIMIT - 1)), -(-to_move // HORSE_LIMIT))
+    groups = left[::HORSE_LIMIT]
+    return sum(groups) + (trips - len(groups)) * fastest + (trips - 1 + passed) * fastest
+
+
+def unpack_spent(spent: int) -> Tuple[int, ...]:
+    """Unpack the time spent by each horse
+
+    Arguments:
+        spent (int): Time spent by each horse, packed into lanes of `LANE_BITS` bits
+
+    Returns:
+        (tuple[int, ...]): Amount of time each horse has accured, by index
+    """
+    return tuple((spent >> (LANE_BITS * i)) & LANE_MASK for i in range(len(SPEEDS)))
+
+
+@lru_cache(maxsize=None)
+def choice_ids(choice: int) -> Tuple[str, ...]:
+    """IDs of a group of horses, cached so that each step of each solution shares them
+
+    Arguments:
+        choice (int): Bitmask of the horses
+
+    Returns:
+        (tuple[str, ...]): IDs of the horses, by index
+    """
+    return tuple(IDS[i] for i in bits(choice))
+
+
+def walk(path: Path) -> Generator[int, None, None]:
+    """Generate the steps of a path, first step first
+
+    Arguments:
+        path (Path): Linked list of steps
+
+    Returns:
+        (Generator[int]): Bitmask of the horses moved in each step
+    """
+    while path:
+        choice, path = path
+        yield choice
+
+
+def step_pool(passed_mask: int, passed: bool) -> List[int]:
+    """Choices of horses to move from a state
+
+    Arguments:
+        passed_mask (int): Bitmask of the horses on the other side
+        passed (bool)    : Whether the human is on the other side of the water
+
+    Returns:
+        (list[int]): Bitmasks of the horses to move
+    """
+    if passed:
+        pool = CHOICE_MASKS_BWD.get(passed_mask)
+        if pool is None:
+            pool = CHOICE_MASKS_BWD[passed_mask] = backward_choices(passed_mask)
+        return pool
+    avail = ~passed_mask & FULL_MASK
+    pool = CHOICE_MASKS_FWD.get(avail)
+    if pool is None:
+        pool = CHOICE_MASKS_FWD[avail] = forward_choices(avail)
+    return pool
+
+
+def merge_completions(completions: List[Completion], num: int, found: List[Completion], num_found: int,
+                      choice: int, time: int) -> int:
+    """Add the completions found from a child state to those of its parent. In optimal mode,
+    only the fastest ones are kept. With `MAX_SOLUTIONS`, once twice as many are kept, only the
+    `MAX_SOLUTIONS` fastest of them are, so no more than that are kept for long
+
+    Arguments:
+        completions (list[Completion]): Completions kept from the parent state; modified
+        num         (int)             : Number of completions found from the parent state
+        found       (list[Completion]): Completions kept from the child state
+        num_found   (int)             : Number of completions found from the child state
+        choice (int)                  : Bitmask of the horses moved to get to the child state
+        time   (int)                  : Amount of time for that step
+
+    Returns:
+        (int): Number of completions found from the parent state, including the child state's
+    """
+    if not found:
+        return num
+    if OPTIMAL_ONLY and completions:
+        best = completions[0][0]
+        total = found[0][0] + time
+        if total > best:
+            return num
+        if total < best:
+            completions.clear()
+            num = 0
+    completions.extend((delta + time, spent, (choice, path)) for delta, spent, path in found)
+    if MAX_SOLUTIONS > 0 and len(completions) >= 2 * MAX_SOLUTIONS:
+        completions[:] = fastest(completions)
+    return num + num_found
+
+
+# Source of the search function. `build_search` bakes the configuration into it: `$NAME`s are
+#   replaced by constants, and `# if FLAG` ... `# else` ... `# endif` blocks are only kept for
+#   the flags that are on, so the search doesn't check the configuration for every step
+SEARCH_TEMPLATE = """
+def search(state, budget):
+    choice_time = CHOICE_TIME
+    choice_spent = CHOICE_SPENT
+    choice_bias = CHOICE_BIAS
+    choice_high = CHOICE_HIGH
+    choice_twins = CHOICE_TWINS
+    lower_bounds = LOWER_BOUNDS
+    best_total = budget
+    # Completions kept from each state, along with the time budget the
+    #   state was searched with and the number of completions found
+    memo = {}
+    # Each frame is [state, tot_time, step_pool, completions, choice, time, budget, num],
+    #   where `choice` and `time` are of the step that led to the state
+    root_frame = [state, 0, iter(step_pool(state[0], state[2])), [], 0, 0, budget, 0]
+    stack = [root_frame]
+    while stack:
+        frame = stack[-1]
+        (passed_mask, spent, passed), tot_time, pool, completions = frame[:4]
+        # if OPTIMAL_ONLY
+        bounds = lower_bounds[not passed]
+        # endif
+        # if BREAK_SYMMETRY
+        avail = passed_mask if passed else ~passed_mask & $FULL_MASK
+        # endif
+        for choice in pool:
+            # if TIME_LIMIT
+            # Has to not exceed time limit
+            if (spent + choice_bias[choice]) & choice_high[choice]:
+                continue
+            # endif
+            # if BREAK_SYMMETRY
+            # Has to not just swap horses of the same speed of another step
+            if choice_twins[choice] and any(
+                    avail >> twin & 1
+                    and (spent >> ($LANE_BITS * twin)) & $LANE_MASK == (spent >> ($LANE_BITS * i)) & $LANE_MASK
+                    for i, twin in choice_twins[choice]):
+                continue
+            # endif
+            time = choice_time[choice]
+            new_mask = passed_mask ^ choice
+            new_tot = tot_time + time
+            # if OPTIMAL_ONLY
+            # Has to be able to beat the best solution so far
+            bound = bounds.get(new_mask)
+            if bound is None:
+                bound = bounds[new_mask] = lower_bound(new_mask, not passed)
+            if new_tot + bound > best_total:
+                continue
+            # endif
+            new_spent = spent + choice_spent[choice]
+            if new_mask == $FULL_MASK:
+                # if OPTIMAL_ONLY
+                best_total = min(best_total, new_tot)
+                # endif
+                frame[7] = merge_completions(
+                    completions, frame[7], [(0, unpack_spent(new_spent), ())], 1, choice, time)
+                continue
+            state = (new_mask, new_spent, not passed)
+            budget = best_total - new_tot
+            cached = memo.get(state)
+            if cached is not None:
+                cached_budget, num, found = cached
+                # The fastest completions are exact, but finding none only
+                #   holds for budgets up to the one searched with
+                if found:
+                    # if OPTIMAL_ONLY
+                    if new_tot + found[0][0] <= best_total:
+                        best_total = min(best_total, new_tot + found[0][0])
+                        frame[7] = merge_completions(completions, frame[7], found, num, choice, time)
+                    # else
+                    frame[7] = merge_completions(completions, frame[7], found, num, choice, time)
+                    # endif
+                    continue
+                if budget <= cached_budget:
+                    continue
+            stack.append([state, new_tot, iter(step_pool(new_mask, not passed)),
+                          [], choice, time, budget, 0])
+            break
+        else:
+            # All children done
+            stack.pop()
+            # if MAX_SOLUTIONS
+            frame[3] = completions = fastest(completions)
+            # endif
+            memo[frame[0]] = (frame[6], frame[7], completions)
+            if stack:
+                parent = stack[-1]
+                parent[7] = merge_completions(
+                    parent[3], parent[7], completions, frame[7], frame[4], frame[5])
+    return root_frame[7], root_frame[3]
+"""
+
+
+def build_search() -> Callable[[State, float], Tuple[int, List[Completion]]]:
+    """Build the search function for the current configuration from `SEARCH_TEMPLATE`
+
+    Returns:
+        (Callable[[State, float], tuple[int, list[Completion]]]): `search(state, budget)`, which
+            returns the number of completions from the state and the ones kept
+    """
+    flags = {
+        "TIME_LIMIT": TIME_MAX != math.inf,
+        "OPTIMAL_ONLY": OPTIMAL_ONLY,
+        "BREAK_SYMMETRY": BREAK_SYMMETRY,
+        "MAX_SOLUTIONS": MAX_SOLUTIONS > 0,
+    }
+    lines = []
+    # Whether each enclosing block is kept
+    keep = []
+    for line in SEARCH_TEMPLATE.splitlines():
+        directive = line.strip()
+        if directive.startswith("# if "):
+            keep.append(flags[directive[len("# if "):]])
+        elif directive == "# else":
+            keep[-1] = not keep[-1]
+        elif directive == "# endif":
+            keep.pop()
+        elif all(keep):
+            lines.append(line)
+    source = Template("\n".join(lines)).substitute(
+        FULL_MASK=FULL_MASK, LANE_BITS=LANE_BITS, LANE_MASK=LANE_MASK)
+    namespace = {}
+    exec(compile(source, "<search>", "exec"), globals(), namespace)
+    return namespace["search"]
+
+
+class Solver:
+    """Depth-first search over the crossing steps
+
+    Each search state is kept as a plain tuple on an explicit stack instead of as a tree node,
+    so expanding a state costs no object construction or recursion
+
+    Arguments:
+        horse_times (list[int]): List of times each horse takes to cross the river
+    """
+    __slots__ = ()
 
     def __init__(self, horse_times: List[int]) -> None:
-        self.parent = None
+        global IDS, SPEEDS, FULL_MASK, CHOICE_TIME, CHOICE_MASKS_FWD, CHOICE_MASKS_BWD, LOWER_BOUNDS
+        global LANE_BITS, LANE_MASK, CHOICE_SPENT, CHOICE_BIAS, CHOICE_HIGH, TWIN_PREV, CHOICE_TWINS
+        global SEARCH
         # Use letters to represent the IDs if there're at most 26 horses;
         #   otherwise, use numbers
         if len(horse_times) <= 26:
-            self.horses = {chr(65 + i): Horse(chr(65 + i), time)
-                           for i, time in enumerate(horse_times)}
+            IDS = tuple(chr(65 + i) for i in range(len(horse_times)))
         else:
-            self.horses = {str(i + 1): Horse(str(i + 1), time)
-                           for i, time in enumerate(horse_times)}
-        self.choice = tuple()
-        self.passed = False
-        self.time = 0
-
-    @property
-    def tot_time(self) -> int:
-        return 0
+            IDS = tuple(str(i + 1) for i in range(len(horse_times)))
+        SPEEDS = tuple(horse_times)
+        choice_ids.cache_clear()
+        FULL_MASK = (1 << len(SPEEDS)) - 1
+        # Crossing time of every group of horses, indexed by bitmask. Each
+        #   group is built from the same group without its lowest horse, so
+        #   each entry takes 1 comparison instead of a pass over its horses
+        CHOICE_TIME = [0] * (FULL_MASK + 1)
+        for choice in range(1, FULL_MASK + 1):
+            rest = choice & (choice - 1)
+            CHOICE_TIME[choice] = max(CHOICE_TIME[rest], SPEEDS[(choice ^ rest).bit_length() - 1])
+        # The time each horse has spent is packed into a single int, with a
+        #   fixed-width lane per horse. Lanes never go over the time limit, so
+        #   they never carry into each other
+        LANE_BITS = 64 if TIME_MAX == math.inf else TIME_MAX.bit_length() + 1
+        LANE_MASK = (1 << LANE_BITS) - 1
+        # Amount added to the packed time spent by every group of horses,
+        #   indexed by bitmask
+        lanes = [0] * (FULL_MASK + 1)
+        for choice in range(1, FULL_MASK + 1):
+            rest = choice & (choice - 1)
+            lanes[choice] = lanes[rest] | 1 << (LANE_BITS * ((choice ^ rest).bit_length() - 1))
+        CHOICE_SPENT = [time * lane for time, lane in zip(CHOICE_TIME, lanes)]
+        # Checks on the time limit for every group of horses, indexed by bitmask.
+        #   Lanes are 1 bit wider than the time limit needs, so adding
+        #   `CHOICE_BIAS[choice]` to the time spent sets the top bit of the lane
+        #   of each horse that would go over, and `CHOICE_HIGH[choice]` picks
+        #   out those top bits
+        if TIME_MAX == math.inf:
+            CHOICE_BIAS = CHOICE_HIGH = [0] * (FULL_MASK + 1)
+        else:
+            top = 1 << (LANE_BITS - 1)
+            CHOICE_BIAS = [(top - 1 - (TIME_MAX - time) if time <= TIME_MAX else top) * lane
+                           for time, lane in zip(CHOICE_TIME, lanes)]
+            CHOICE_HIGH = [top * lane for lane in lanes]
+        # Previous horse with the same speed as each horse, or -1 if none. A
+        #   step is skipped when it moves a horse but not its twin, and the
+        #   twin is on the same side and has spent the same time, since then
+        #   swapping the 2 gives the same step. Every path, with horses
+        #   replaced by their speeds, is still found, but this is decided
+        #   state by state, so some solutions are dropped even though no kept
+        #   solution is a relabelling of them
+        TWIN_PREV = [-1] * len(SPEEDS)
+        if BREAK_SYMMETRY:
+            for i, speed in enumerate(SPEEDS):
+                TWIN_PREV[i] = max((j for j in range(i) if SPEEDS[j] == speed), default=-1)
+        # (horse, twin) pairs to check for every group of horses, indexed by bitmask
+        CHOICE_TWINS = [tuple((i, TWIN_PREV[i]) for i in bits(choice)
+                              if TWIN_PREV[i] >= 0 and not choice >> TWIN_PREV[i] & 1)
+                        for choice in range(FULL_MASK + 1)]
+        # Choices available from each bitmask of horses, filled in as the
+        #   search reaches them
+        CHOICE_MASKS_FWD = {}
+        CHOICE_MASKS_BWD = {}
+        # Lower bounds on the time left from each bitmask of passed horses,
+        #   indexed by which side the human is on
+        LOWER_BOUNDS = ({}, {})
+        SEARCH = build_search()
+
+    def execute(self) -> Tuple[int, List[Solution]]:
+        """Run the search from the state where no horse has crossed. With more than 1
+        process, each first step is searched in its own job
+
+        Returns:
+            (int)           : Number of solutions found
+            (list[Solution]): The `MAX_SOLUTIONS` fastest solutions, or all of them if it's 0
+        """
+        if NUM_PROCESSES == 1:
+            num_of_solutions, completions = self.search_from((0, 0, False))
+        else:
+            shared_best = multiprocessing.Value("q", -1)
+            with ProcessPoolExecutor(
+                    NUM_PROCESSES or os.cpu_count(), initializer=init_worker,
+                    initargs=(SPEEDS, TIME_MAX, HORSE_LIMIT, OPTIMAL_ONLY, MAX_SOLUTIONS,
+                              BREAK_SYMMETRY, river_core is not None, shared_best)) as executor:
+                choices = step_pool(0, False)
+                num_of_solutions = 0
+                completions = []
+                # Merge the results as they come in, so only the fastest are kept
+                for choice, (num, found) in zip(choices, executor.map(solve_subtree, choices)):
+                    num_of_solutions = merge_completions(
+                        completions, num_of_solutions, found, num, choice, CHOICE_TIME[choice])
+            completions = fastest(completions)
+        return num_of_solutions, [Solution(
+            total_time,
+            spent,
+            [choice_ids(choice) for choice in walk(path)])
+            for total_time, spent, path in completions]
+
+    def search_from(self, state: State, budget: float = math.inf) -> Tuple[int, List[Completion]]:
+        """Run the search from a state, in the compiled kernel if it's loaded
+
+        Arguments:
+            state (State)  : State to start from
+            budget (float) : Only look for completions that take at most this much time in optimal mode
+
+        Returns:
+            (int)             : Number of completions from the state
+            (list[Completion]): The `MAX_SOLUTIONS` fastest of them, or all of them if it's 0
+        """
+        if river_core is not None and len(SPEEDS) <= river_core.MAX_HORSES:
+            passed_mask, spent, passed = state
+            return river_core.solve(
+                len(SPEEDS), CHOICE_TIME, None if TIME_MAX == math.inf else TIME_MAX,
+                OPTIMAL_ONLY, MAX_SOLUTIONS, step_pool, lower_bound, TWIN_PREV if BREAK_SYMMETRY else None,
+                passed_mask, unpack_spent(spent), passed, None if budget == math.inf else budget)
+        return self.search(state, budget)
 
-    @property
-    def path(self) -> List[Tuple[str, ...]]:
-        return []
+    def search(self, state: State, budget: float = math.inf) -> Tuple[int, List[Completion]]:
+        """Run the search from a state, in the search function specialized for this configuration
 
-    def execute(self) -> List[Solution]:
-        """Generate child nodes and run testing on each path
+        Arguments:
+            state (State)  : State to start from
+            budget (float) : Only look for completions that take at most this much time in optimal mode
 
         Returns:
-            (list[Solution]): List of all solutions
+            (int)             : Number of completions from the state
+            (list[Completion]): The `MAX_SOLUTIONS` fastest of them, or all of them if it's 0
         """
-        avail_horses = tuple(self.avail_horses)
-        step_pool = (c for r in range(2, HORSE_LIMIT + 1)
-                     for c in combinations(avail_horses, r))
-        pot_children = (Step(self, self.horses, choice, not self.passed)
-                        for choice in step_pool)
-        # Check each potential children
-        paths: List[Solution] = []
-        for s in pot_children:
-            # Has to not exceed time limit
-            if not s.is_viable:
-                continue
-            # Kinda recursion
-            children_paths = s.execute()
-            if len(children_paths) > 0:
-                paths += children_paths
-        return paths
+        return SEARCH(state, budget)
+
+
+def fastest(completions: Iterable[Completion]) -> List[Completion]:
+    """Keep the `MAX_SOLUTIONS` fastest completions with a bounded heap. Ties stay in the order
+    they were found
+
+    Arguments:
+        completions (Iterable[Completion]): Completions found
+
+    Returns:
+        (list[Completion]): The fastest completions, or all of them if `MAX_SOLUTIONS` is 0
+    """
+    if MAX_SOLUTIONS <= 0:
+        return list(completions)
+    return heapq.nsmallest(MAX_SOLUTIONS, completions, key=itemgetter(0))
+
+
+def load_kernel() -> None:
+    """Load the compiled search kernel, building it if needed
+
+    It needs Cython and a C compiler, and it's skipped on PyPy, whose JIT runs the Python search faster
+    than it can call into a C extension. It doesn't share the memo of the Python search, so it's only
+    faster on some inputs
+    """
+    global river_core
+    if platform.python_implementation() != "CPython":
+        warnings.warn("The compiled search kernel is only used on CPython")
+        return
+    try:
+        import pyximport
+        pyximport.install(language_level=3)
+        import river_core as kernel
+    except ImportError as e:
+        warnings.warn(f"The compiled search kernel couldn't be loaded: {e}")
+        return
+    river_core = kernel
+
+
+def init_worker(horse_times: List[int], time_max: float, horse_limit: int, optimal_only: bool,
+                max_solutions: int, break_symmetry: bool, compiled_kernel: bool, shared_best) -> None:
+    """Set up the configuration and tables in a worker process
+
+    Arguments:
+        horse_times (list[int])    : List of times each horse takes to cross the river
+        time_max (float)           : The limit on amount of time each horse can go
+        horse_limit (int)          : The number of horses that can go at once
+        optimal_only (bool)        : Whether to only keep the solutions with the least total time
+        max_solutions (int)        : Number of fastest solutions to keep; 0 for all
+        break_symmetry (bool)      : Whether to skip steps that only swap horses of the same speed
+        compiled_kernel (bool)     : Whether to search in the compiled kernel
+        shared_best (multiprocessing.Value): Least total time found by any worker; -1 if none
+    """
+    global TIME_MAX, HORSE_LIMIT, OPTIMAL_ONLY, MAX_SOLUTIONS, BREAK_SYMMETRY, NUM_PROCESSES, SOLVER
+    global SHARED_BEST
+    TIME_MAX = time_max
+    HORSE_LIMIT = horse_limit
+    OPTIMAL_ONLY = optimal_only
+    MAX_SOLUTIONS = max_solutions
+    BREAK_SYMMETRY = break_symmetry
+    NUM_PROCESSES = 1
+    if compiled_kernel:
+        load_kernel()
+    SOLVER = Solver(horse_times)
+    SHARED_BEST = shared_best
+
+
+def solve_subtree(choice: int) -> Tuple[int, List[Completion]]:
+    """Search all solutions starting with a first step, in a worker process
+
+    In optimal mode, the least total time found by any worker when this job starts is used to
+    prune the search, and the job's own best is shared when it's done
+
+    Arguments:
+        choice (int): Bitmask of the horses brought over in the first step
+
+    Returns:
+        (int)             : Number of solutions starting with the step
+        (list[Completion]): The `MAX_SOLUTIONS` fastest of them, relative to after the step
+    """
+    time = CHOICE_TIME[choice]
+    # Has to not exceed time limit, and not just swap horses of the same speed
+    #   of another step
+    if time > TIME_MAX or (BREAK_SYMMETRY and CHOICE_TWINS[choice]):
+        return 0, []
+    spent = CHOICE_SPENT[choice]
+    if choice == FULL_MASK:
+        num, found = 1, [(0, unpack_spent(spent), ())]
+    else:
+        budget = math.inf
+        if OPTIMAL_ONLY and SHARED_BEST.value >= 0:
+            budget = SHARED_BEST.value - time
+        num, found = SOLVER.search_from((choice, spent, True), budget)
+    if OPTIMAL_ONLY and found:
+        with SHARED_BEST.get_lock():
+            if SHARED_BEST.value < 0 or found[0][0] + time < SHARED_BEST.value:
+                SHARED_BEST.value = found[0][0] + time
+    return num, found
 
 
 def main(horse_times: List[int]) -> None:
-    root_step = RootStep(horse_times)
-    paths = root_step.execute()
+    num_of_solutions, paths = Solver(horse_times).execute()
     solution = {
-        "num_of_solutions": len(paths),
-        "solutions": [{
-            "total_time": sol.total_time,
-            "horses_time": list(sol.horses_time),
-            "path": [list(step) for step in sol.path]
-        } for sol in sorted(paths, key=lambda s: s.total_time)]
+        "num_of_solutions": num_of_solutions,
+        "solutions": sorted(paths, key=attrgetter("total_time"))
     }
-    with open(SOLUTION_PATH, "w") as f:
-        json.dump(solution, f)
+    # orjson writes dataclasses as is. json.dumps, unlike json.dump, uses the
+    #   C encoder
+    if orjson is not None:
+        with open(SOLUTION_PATH, "wb") as f:
+            f.write(orjson.dumps(solution))
+    else:
+        with open(SOLUTION_PATH, "w") as f:
+            f.write(json.dumps(solution, default=lambda sol: {
+                "total_time": sol.total_time,
+                "horses_time": sol.horses_time,
+                "path": sol.path
+            }))
 
 
 if __name__ == "__main__":
@@ -220,4 +618,16 @@ if __name__ == "__main__":
     if HORSE_LIMIT < 2:
         raise ValueError(
             f"At least 2 horses have to be able to go at the same time. Current limit {HORSE_LIMIT}")
+    OPTIMAL_ONLY = config.get("optimal_only", False)
+    NUM_PROCESSES = config.get("num_processes", 1)
+    if NUM_PROCESSES < 0:
+        raise ValueError(
+            f"The number of processes can't be negative. Use 0 for 1 per CPU. Current number {NUM_PROCESSES}")
+    MAX_SOLUTIONS = config.get("max_solutions", 0)
+    if MAX_SOLUTIONS < 0:
+        raise ValueError(
+            f"The number of solutions to keep can't be negative. Current number {MAX_SOLUTIONS}")
+    BREAK_SYMMETRY = config.get("break_symmetry", False)
+    if config.get("compiled_kernel", False):
+        load_kernel()
     main(config["horse_times"])